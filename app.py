@@ -1,32 +1,128 @@
+import csv
+import io
 import os
+import queue
 import sqlite3
 import datetime as dt
+import hashlib
+import hmac
 import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import wraps
-from flask import Flask, g, render_template, request, redirect, url_for, session, flash
-from werkzeug.security import generate_password_hash, check_password_hash
+from itertools import count, repeat
+
+import click
+import numpy as np
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from flask import Flask, g, has_request_context, render_template, request, redirect, url_for, session, flash
+from flask_caching import Cache
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.security import check_password_hash
 
 APP_DIR = os.path.abspath(os.path.dirname(__file__))
 DB_PATH = os.path.join(APP_DIR, "instance", "heartwatch.db")
+os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "dev-secret-change-me")
+cache = Cache(app, config={"CACHE_TYPE": "SimpleCache", "CACHE_DEFAULT_TIMEOUT": 5})
+
+# Compiled templates survive restarts, so a new worker skips the Jinja compile
+JINJA_CACHE_DIR = os.path.join(APP_DIR, ".jinja_cache")
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory=JINJA_CACHE_DIR)
 
 
 # ================== DB ==================
-def get_db():
+def _configure_connection(db):
+    # Per-connection settings; WAL itself is persistent and set in init_db().
+    # With WAL, synchronous=NORMAL avoids an fsync on every commit.
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-20000")
+    db.execute("PRAGMA mmap_size=268435456")
+
+
+# Connections stay open for the life of the process so SQLite's page cache
+# survives between requests: one shared writer, serialized by a lock, plus a
+# pool of read-only connections for GET requests.
+_rw_conn = None
+_rw_lock = threading.Lock()
+_ro_pool = queue.LifoQueue()
+
+
+def _connect(readonly=False):
+    # Autocommit mode: multi-statement writes use transaction() explicitly
+    if readonly:
+        db = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, cached_statements=256,
+                             isolation_level=None, check_same_thread=False)
+    else:
+        db = sqlite3.connect(DB_PATH, cached_statements=256,
+                             isolation_level=None, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    _configure_connection(db)
+    return db
+
+
+def _writer():
+    global _rw_conn
+    if _rw_conn is None:
+        _rw_conn = _connect()
+    return _rw_conn
+
+
+def get_db(readonly=None):
+    """Connection for this app context; GET/HEAD requests read-only by default."""
     if "db" not in g:
-        os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-        g.db = sqlite3.connect(DB_PATH)
-        g.db.row_factory = sqlite3.Row
+        if readonly is None:
+            readonly = has_request_context() and request.method in ("GET", "HEAD")
+        if readonly:
+            try:
+                g.db = _ro_pool.get_nowait()
+            except queue.Empty:
+                g.db = _connect(readonly=True)
+        else:
+            _rw_lock.acquire()
+            try:
+                g.db = _writer()
+            except BaseException:
+                # close_db() only releases once g.db is set
+                _rw_lock.release()
+                raise
+        g.db_readonly = readonly
     return g.db
 
 
+@contextmanager
+def transaction(db, mode="DEFERRED"):
+    db.execute(f"BEGIN {mode}")
+    try:
+        yield db
+    except BaseException:
+        # SQLite may already have rolled back (e.g. SQLITE_FULL); a second
+        # ROLLBACK would raise and hide the original error
+        if db.in_transaction:
+            db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
 @app.teardown_appcontext
 def close_db(exception=None):
+    # Hand the connection back; drop anything the request left uncommitted
     db = g.pop("db", None)
-    if db is not None:
-        db.close()
+    if db is None:
+        return
+    if db.in_transaction:
+        db.rollback()
+    if g.pop("db_readonly"):
+        _ro_pool.put(db)
+    else:
+        _rw_lock.release()
 
 
 def _table_columns(db, table_name: str):
@@ -43,47 +139,88 @@ def _ensure_column(db, table: str, col: str, col_type: str):
         db.execute(f"ALTER TABLE {table} ADD COLUMN {col} {col_type}")
 
 
-def init_db():
+def _ts_epoch_sql(value: str) -> str:
+    """SQL expression for the Unix seconds of a ts value (NULL if unparseable).
+
+    All-digit stamps are taken as epoch seconds; strftime() would read them as
+    Julian day numbers.
+    """
+    return (
+        f"CASE WHEN {value} <> '' AND {value} NOT GLOB '*[^0-9]*' "
+        f"THEN CAST({value} AS INTEGER) "
+        f"ELSE CAST(strftime('%s', {value}) AS INTEGER) END"
+    )
+
+
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS readings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        ts TEXT NOT NULL,
+        bpm INTEGER NOT NULL,
+        status TEXT,
+        label INTEGER,
+        created_at TEXT,
+        ts_epoch INTEGER
+    );
+
+    CREATE TABLE IF NOT EXISTS contacts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        phone TEXT,
+        email TEXT,
+        created_at TEXT
+    );
+
+    CREATE TABLE IF NOT EXISTS alerts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        ts TEXT NOT NULL,
+        bpm INTEGER NOT NULL,
+        location TEXT,
+        recipients TEXT,
+        created_at TEXT
+    );
+"""
+
+# Applied after the column migrations, since they reference migrated columns
+INDEX_SQL = """
+    DROP INDEX IF EXISTS idx_readings_user_ts;
+    DROP INDEX IF EXISTS idx_readings_user_ts_cover;
+    DROP INDEX IF EXISTS idx_readings_user_epoch;
+
+    -- Orders by integer time (ts text breaks ties, including unparseable stamps)
+    -- and covers the dashboard/alert queries, so they never touch the table
+    CREATE INDEX IF NOT EXISTS idx_readings_user_epoch_ts ON readings(user_id, ts_epoch DESC, ts DESC, bpm, status);
+    CREATE INDEX IF NOT EXISTS idx_alerts_user_ts ON alerts(user_id, ts DESC);
+    CREATE INDEX IF NOT EXISTS idx_contacts_user ON contacts(user_id);
+"""
+
+
+# Bump when SCHEMA_SQL, INDEX_SQL or the column migrations below change
+SCHEMA_VERSION = 3
+
+
+def init_db(force=False):
+    global _rw_conn
     db = get_db()
+    # Already migrated: skip the DDL and column probes entirely, unless forced
+    if not force and db.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
+
+    # Stored in the database file, so this only needs to happen once
+    db.execute("PRAGMA journal_mode=WAL")
 
     # Create tables (safe)
-    db.executescript("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            created_at TEXT NOT NULL
-        );
-
-        CREATE TABLE IF NOT EXISTS readings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            ts TEXT NOT NULL,
-            bpm INTEGER NOT NULL,
-            status TEXT,
-            label INTEGER,
-            created_at TEXT
-        );
-
-        CREATE TABLE IF NOT EXISTS contacts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            name TEXT NOT NULL,
-            phone TEXT,
-            email TEXT,
-            created_at TEXT
-        );
-
-        CREATE TABLE IF NOT EXISTS alerts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            ts TEXT NOT NULL,
-            bpm INTEGER NOT NULL,
-            location TEXT,
-            recipients TEXT,
-            created_at TEXT
-        );
-    """)
+    db.executescript(SCHEMA_SQL)
 
     # Auto-migrate missing columns (fixes 500 after login)
     try:
@@ -98,65 +235,65 @@ def init_db():
         _ensure_column(db, "alerts", "location", "TEXT")
         _ensure_column(db, "alerts", "recipients", "TEXT")
         _ensure_column(db, "alerts", "created_at", "TEXT")
+
+        _ensure_column(db, "readings", "ts_epoch", "INTEGER")
     except sqlite3.Error:
+        # Recreating the file drops every account and reading, so only do it
+        # when a reset is explicitly requested
+        if os.environ.get("HEARTWATCH_RESET") != "1":
+            raise
+
         # إذا صار شي غريب بالملف القديم، نعمل إعادة إنشاء نظيفة
         try:
             db.close()
         except Exception:
             pass
-        if os.path.exists(DB_PATH):
-            os.remove(DB_PATH)
+        for path in (DB_PATH, DB_PATH + "-wal", DB_PATH + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
 
         # افتح DB من جديد وأنشئ كل شيء
-        db = sqlite3.connect(DB_PATH)
-        db.row_factory = sqlite3.Row
-        db.executescript("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                created_at TEXT NOT NULL
-            );
-
-            CREATE TABLE IF NOT EXISTS readings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                ts TEXT NOT NULL,
-                bpm INTEGER NOT NULL,
-                status TEXT,
-                label INTEGER,
-                created_at TEXT
-            );
-
-            CREATE TABLE IF NOT EXISTS contacts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                name TEXT NOT NULL,
-                phone TEXT,
-                email TEXT,
-                created_at TEXT
-            );
-
-            CREATE TABLE IF NOT EXISTS alerts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                ts TEXT NOT NULL,
-                bpm INTEGER NOT NULL,
-                location TEXT,
-                recipients TEXT,
-                created_at TEXT
-            );
-        """)
-        db.commit()
-
-    db.commit()
-
-
-@app.before_request
-def _ensure_db():
+        _rw_conn = None
+        db = g.db = _writer()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA_SQL)
+
+    # Unix seconds for rows stored before ts_epoch existed, and for all-digit
+    # stamps that older versions parsed as Julian days; unparseable ts stay NULL
+    db.execute(
+        f"UPDATE readings SET ts_epoch = {_ts_epoch_sql('ts')} "
+        "WHERE ts_epoch IS NULL OR ts NOT GLOB '*[^0-9]*'"
+    )
+    db.executescript(INDEX_SQL)
+    db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+
+# Schema setup runs once at import, not on every request
+with app.app_context():
     init_db()
 
 
+@app.cli.command("init-db")
+def init_db_command():
+    """Create missing tables, indexes and columns, even if the schema version is current."""
+    init_db(force=True)
+    click.echo("Initialized the database.")
+
+
+# ================== QUERIES ==================
+# Shared by several views; identical text means one prepared statement per
+# pooled connection (sqlite3's statement cache is keyed by the SQL string)
+# ts_epoch is derived from the ts parameter (?2) so callers only pass it once
+INSERT_READING_SQL = (
+    "INSERT INTO readings (user_id, ts, ts_epoch, bpm, status, label, created_at) "
+    f"VALUES (?1, ?2, {_ts_epoch_sql('?2')}, ?3, ?4, ?5, ?6)"
+)
+LATEST_READING_SQL = (
+    "SELECT ts, bpm, COALESCE(status,'normal') AS status FROM readings WHERE user_id=? ORDER BY ts_epoch DESC, ts DESC LIMIT 1"
+)
+USER_CONTACTS_SQL = "SELECT name, phone, email FROM contacts WHERE user_id=? ORDER BY id DESC"
+
+
 # ================== AUTH ==================
 def login_required(view):
     @wraps(view)
@@ -167,14 +304,112 @@ def login_required(view):
     return wrapped
 
 
+# Argon2id password hashing; the cost can be lowered on slow hosts
+_password_hasher = PasswordHasher(
+    time_cost=int(os.environ.get("HW_ARGON2_TIME_COST", "2")),
+    memory_cost=int(os.environ.get("HW_ARGON2_MEMORY_COST", "65536")),
+    parallelism=int(os.environ.get("HW_ARGON2_PARALLELISM", "1")),
+)
+
+
+def hash_password(password: str) -> str:
+    return _password_hasher.hash(password)
+
+
+def verify_password(password_hash: str, password: str) -> bool:
+    # Accounts created before the switch to argon2 keep their Werkzeug hashes
+    if not password_hash.startswith("$argon2"):
+        return check_password_hash(password_hash, password)
+    try:
+        return _password_hasher.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+
+def needs_rehash(password_hash: str) -> bool:
+    # Legacy Werkzeug hashes, and argon2 hashes made with older cost settings
+    if not password_hash.startswith("$argon2"):
+        return True
+    try:
+        return _password_hasher.check_needs_rehash(password_hash)
+    except InvalidHashError:
+        return False
+
+
+def rehash_password(user_id, password: str) -> None:
+    # Hash before taking the writer so the lock is only held for the UPDATE;
+    # the caller's g.db may be read-only, hence the shared writer directly
+    password_hash = hash_password(password)
+    with _rw_lock:
+        _writer().execute(
+            "UPDATE users SET password_hash=? WHERE id=?", (password_hash, user_id)
+        )
+
+
+# Small LRU of recent password checks, so identical retries within the TTL skip
+# the KDF. Keys pair the submitted email with an HMAC of the password under the
+# app secret, so the plaintext is never kept. Unknown emails are cached under
+# their own key too (against the dummy hash), so a repeated (email, guess) pair
+# takes the same time whether or not the account exists. The stored hash is
+# kept with each entry and must match, so a password change invalidates it.
+# Trade-off: a repeated guess costs nothing; HW_LOGIN_CACHE_TTL=0 disables it.
+LOGIN_CACHE_TTL = float(os.environ.get("HW_LOGIN_CACHE_TTL", "30"))
+LOGIN_CACHE_SIZE = 128
+_login_cache = OrderedDict()
+_login_cache_lock = threading.Lock()
+
+
+def verify_password_cached(email: str, password_hash: str, password: str) -> bool:
+    if LOGIN_CACHE_TTL <= 0:
+        return verify_password(password_hash, password)
+
+    digest = hmac.new(app.secret_key.encode(), password.encode(), hashlib.sha256).digest()
+    key = (email, digest)
+    now = time.monotonic()
+    with _login_cache_lock:
+        hit = _login_cache.get(key)
+        if hit is not None and hit[0] == password_hash and now - hit[1] < LOGIN_CACHE_TTL:
+            _login_cache.move_to_end(key)
+            return hit[2]
+
+    ok = verify_password(password_hash, password)
+    with _login_cache_lock:
+        _login_cache[key] = (password_hash, now, ok)
+        _login_cache.move_to_end(key)
+        while len(_login_cache) > LOGIN_CACHE_SIZE:
+            _login_cache.popitem(last=False)
+    return ok
+
+
+# Compared against when the email is unknown, to keep login timing uniform
+_DUMMY_HASH = hash_password("invalid-placeholder-password")
+
+
 def current_user():
+    # Built from the signed session; only sessions created before the email
+    # was stored there need a users lookup (once per request)
+    if "user" in g:
+        return g.user
     uid = session.get("user_id")
     if not uid:
+        g.user = None
         return None
-    return get_db().execute("SELECT * FROM users WHERE id=?", (uid,)).fetchone()
+    email = session.get("user_email")
+    if email is None:
+        row = get_db().execute("SELECT email FROM users WHERE id=?", (uid,)).fetchone()
+        if row is None:
+            g.user = None
+            return None
+        email = session["user_email"] = row["email"]
+    g.user = {"id": uid, "email": email}
+    return g.user
 
 
 # ================== LOGIC ==================
+# Seeded once per process, independent of the global random module state
+_rng = random.Random()
+
+
 def detect_status(bpm: int) -> str:
     if bpm > 150:
         return "critical"
@@ -183,6 +418,99 @@ def detect_status(bpm: int) -> str:
     return "normal"
 
 
+# detect_status() for every bpm 0..255; anything outside is clamped into range,
+# which keeps the same result since all thresholds fall inside it
+_STATUS_TABLE = np.array([detect_status(b) for b in range(256)])
+
+
+def detect_statuses(bpms) -> list:
+    """Vectorized detect_status() for a batch of readings."""
+    return _STATUS_TABLE[np.clip(bpms, 0, 255)].tolist()
+
+
+# ================== UPLOAD ==================
+UPLOAD_BATCH_SIZE = 1000
+
+
+# SQLite's INTEGER range; also keeps batches within NumPy's int64
+_INT_MIN = -(2 ** 63)
+_INT_MAX = 2 ** 63 - 1
+
+
+def _to_int(raw):
+    # Plain integer strings are the common case; only fall back to float
+    # parsing for values like "72.0". Out-of-range values count as unparseable.
+    try:
+        value = int(raw)
+    except ValueError:
+        try:
+            value = int(float(raw))
+        except (ValueError, OverflowError):
+            return None
+    if not _INT_MIN <= value <= _INT_MAX:
+        return None
+    return value
+
+
+def _insert_readings(db, uid, stamps, bpms, labels, created_at):
+    statuses = detect_statuses(bpms)
+    db.executemany(
+        INSERT_READING_SQL,
+        zip(repeat(uid), stamps, bpms, statuses, labels, repeat(created_at)),
+    )
+    return len(bpms)
+
+
+# ================== CACHE ==================
+# Per-user data version, bumped after every write so cached dashboard and
+# history data is never served stale. The cache is in-process, so with several
+# gunicorn workers another worker may serve data up to the cache timeout old.
+_user_ver = {}
+_ver_counter = count(1)
+
+
+def bump_user_version(uid):
+    _user_ver[uid] = next(_ver_counter)
+
+
+@cache.memoize()
+def _dashboard_data(uid, version):
+    db = get_db()
+
+    latest = db.execute(LATEST_READING_SQL, (uid,)).fetchone()
+
+    # Latest 50, returned oldest-first for the chart
+    recent = db.execute(
+        "SELECT ts, bpm, status FROM ("
+        "SELECT ts_epoch, ts, bpm, COALESCE(status,'normal') AS status FROM readings WHERE user_id=? ORDER BY ts_epoch DESC, ts DESC LIMIT 50"
+        ") ORDER BY ts_epoch ASC, ts ASC",
+        (uid,)
+    ).fetchall()
+    recent_list = [dict(r) for r in recent]
+
+    contacts = db.execute(USER_CONTACTS_SQL, (uid,)).fetchall()
+
+    # Plain dicts, since cached values are pickled
+    return dict(latest) if latest else None, recent_list, [dict(c) for c in contacts]
+
+
+@cache.memoize()
+def _history_data(uid, version):
+    db = get_db()
+
+    readings = db.execute(
+        "SELECT ts, bpm, COALESCE(status,'normal') AS status, label FROM readings WHERE user_id=? ORDER BY ts_epoch DESC, ts DESC LIMIT 200",
+        (uid,)
+    ).fetchall()
+
+    alerts = db.execute(
+        "SELECT ts, bpm, location, recipients FROM alerts WHERE user_id=? ORDER BY ts DESC LIMIT 50",
+        (uid,)
+    ).fetchall()
+
+    return [dict(r) for r in readings], [dict(a) for a in alerts]
+
+
 # ================== ROUTES ==================
 @app.route("/")
 def index():
@@ -199,13 +527,14 @@ def register():
             flash("Email and password are required.", "danger")
             return redirect(url_for("register"))
 
+        # Hash before taking the writer connection so its lock isn't held during the KDF
+        password_hash = hash_password(password)
         db = get_db()
         try:
             db.execute(
                 "INSERT INTO users (email, password_hash, created_at) VALUES (?, ?, ?)",
-                (email, generate_password_hash(password), dt.datetime.utcnow().isoformat())
+                (email, password_hash, dt.datetime.utcnow().isoformat())
             )
-            db.commit()
         except sqlite3.IntegrityError:
             flash("This email is already registered.", "warning")
             return redirect(url_for("register"))
@@ -222,16 +551,29 @@ def login():
         email = request.form.get("email", "").strip().lower()
         password = request.form.get("password", "")
 
-        user = get_db().execute(
-            "SELECT * FROM users WHERE email=?", (email,)
+        user = get_db(readonly=True).execute(
+            "SELECT id, password_hash FROM users WHERE email=?", (email,)
         ).fetchone()
 
-        if user is None or not check_password_hash(user["password_hash"], password):
+        # Always run one hash check so unknown emails take as long as wrong passwords
+        if user is None:
+            verify_password_cached(email, _DUMMY_HASH, password)
+            ok = False
+        else:
+            ok = verify_password_cached(email, user["password_hash"], password)
+
+        if not ok:
             flash("Invalid email or password.", "danger")
             return redirect(url_for("login"))
 
+        # Move legacy accounts onto argon2, so every account (and the dummy
+        # check for unknown emails) costs the same to verify
+        if needs_rehash(user["password_hash"]):
+            rehash_password(user["id"], password)
+
         session.clear()
         session["user_id"] = user["id"]
+        session["user_email"] = email
         return redirect(url_for("dashboard"))
 
     return render_template("login.html")
@@ -246,53 +588,36 @@ def logout():
 @app.route("/dashboard")
 @login_required
 def dashboard():
-    db = get_db()
     uid = session["user_id"]
-
-    latest = db.execute(
-        "SELECT ts, bpm, COALESCE(status,'normal') AS status FROM readings WHERE user_id=? ORDER BY ts DESC LIMIT 1",
-        (uid,)
-    ).fetchone()
-
-    recent = db.execute(
-        "SELECT ts, bpm, COALESCE(status,'normal') AS status FROM readings WHERE user_id=? ORDER BY ts DESC LIMIT 50",
-        (uid,)
-    ).fetchall()
-    recent_list = list(reversed([dict(r) for r in recent]))
-
-    contacts = db.execute(
-        "SELECT * FROM contacts WHERE user_id=? ORDER BY id DESC",
-        (uid,)
-    ).fetchall()
-
+    latest, recent_list, contacts = _dashboard_data(uid, _user_ver.get(uid, 0))
     return render_template("dashboard.html", latest=latest, recent=recent_list, contacts=contacts)
 
 
 @app.route("/simulate", methods=["POST"])
 @login_required
 def simulate():
-    db = get_db()
     uid = session["user_id"]
-
     mode = request.form.get("mode", "normal")
 
+    # One 16-bit draw per reading; for abnormal, the low bit picks the band
+    r = _rng.getrandbits(16)
     if mode == "normal":
-        bpm = random.randint(60, 90)
+        bpm = 60 + r % 31
     elif mode == "abnormal":
-        bpm = random.choice([random.randint(121, 150), random.randint(35, 44)])
+        bpm = 121 + (r >> 1) % 30 if r & 1 else 35 + (r >> 1) % 10
     elif mode == "attack":
-        bpm = random.randint(155, 190)
+        bpm = 155 + r % 36
     else:
-        bpm = random.randint(40, 180)
+        bpm = 40 + r % 141
 
     status = detect_status(int(bpm))
-    now = dt.datetime.utcnow().isoformat(sep=" ", timespec="seconds")
+    now = dt.datetime.utcnow()
 
-    db.execute(
-        "INSERT INTO readings (user_id, ts, bpm, status, label, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-        (uid, now, int(bpm), status, None, dt.datetime.utcnow().isoformat())
+    get_db().execute(
+        INSERT_READING_SQL,
+        (uid, now.isoformat(sep=" ", timespec="seconds"), int(bpm), status, None, now.isoformat())
     )
-    db.commit()
+    bump_user_version(uid)
 
     return redirect(url_for("dashboard"))
 
@@ -300,30 +625,28 @@ def simulate():
 @app.route("/alert", methods=["POST"])
 @login_required
 def alert():
-    db = get_db()
     uid = session["user_id"]
+    location = request.form.get("location", "").strip() or "Demo location"
 
-    latest = db.execute(
-        "SELECT ts, bpm, COALESCE(status,'normal') AS status FROM readings WHERE user_id=? ORDER BY ts DESC LIMIT 1",
-        (uid,)
-    ).fetchone()
+    db = get_db()
+    latest = db.execute(LATEST_READING_SQL, (uid,)).fetchone()
 
     if latest is None:
         flash("No reading available. Simulate or upload first.", "warning")
         return redirect(url_for("dashboard"))
 
-    location = request.form.get("location", "").strip() or "Demo location"
     contacts = db.execute(
         "SELECT name, phone, email FROM contacts WHERE user_id=?",
         (uid,)
     ).fetchall()
     recipients = ", ".join([f"{c['name']}" for c in contacts]) or "No contacts saved"
 
+    now = dt.datetime.utcnow()
     db.execute(
         "INSERT INTO alerts (user_id, ts, bpm, location, recipients, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-        (uid, dt.datetime.utcnow().isoformat(sep=" ", timespec="seconds"), int(latest["bpm"]), location, recipients, dt.datetime.utcnow().isoformat())
+        (uid, now.isoformat(sep=" ", timespec="seconds"), int(latest["bpm"]), location, recipients, now.isoformat())
     )
-    db.commit()
+    bump_user_version(uid)
 
     flash("🚨 Emergency alert sent (simulated).", "danger")
     return redirect(url_for("dashboard"))
@@ -338,32 +661,60 @@ def upload():
             flash("Please choose a CSV file.", "warning")
             return redirect(url_for("upload"))
 
-        import csv
-        content = file.read().decode("utf-8", errors="ignore").splitlines()
-        reader = csv.DictReader(content)
+        # Decode the upload incrementally instead of reading it all into memory
+        stream = io.TextIOWrapper(file.stream, encoding="utf-8", errors="ignore", newline="")
+        reader = csv.reader(stream)
+        header = next(reader, None)
+        if not header:
+            flash("The CSV file is empty.", "warning")
+            return redirect(url_for("upload"))
+
+        # Resolve column positions once so the loop only indexes into row lists
+        columns = [h.strip().lower() for h in header]
+        if "timestamp" not in columns or "bpm" not in columns:
+            flash("CSV must include timestamp and bpm columns.", "warning")
+            return redirect(url_for("upload"))
+        ts_idx = columns.index("timestamp")
+        bpm_idx = columns.index("bpm")
+        label_idx = columns.index("label") if "label" in columns else None
+        min_len = max(ts_idx, bpm_idx) + 1
 
         db = get_db()
         uid = session["user_id"]
+        created_at = dt.datetime.utcnow().isoformat()
         inserted = 0
+        stamps, bpms, labels = [], [], []
+
+        # Insert in chunks with executemany, all inside a single transaction that
+        # takes the write lock up front rather than upgrading mid-upload
+        with transaction(db, "IMMEDIATE"):
+            for row in reader:
+                if len(row) < min_len:
+                    continue
+                ts = row[ts_idx].strip()
+                bpm_raw = row[bpm_idx].strip()
+                if not ts or not bpm_raw:
+                    continue
+                bpm = _to_int(bpm_raw)
+                if bpm is None:
+                    continue
+
+                label = None
+                if label_idx is not None and label_idx < len(row):
+                    label = _to_int(row[label_idx])
+
+                stamps.append(ts)
+                bpms.append(bpm)
+                labels.append(label)
+                if len(bpms) >= UPLOAD_BATCH_SIZE:
+                    inserted += _insert_readings(db, uid, stamps, bpms, labels, created_at)
+                    stamps, bpms, labels = [], [], []
+
+            if bpms:
+                inserted += _insert_readings(db, uid, stamps, bpms, labels, created_at)
+
+        bump_user_version(uid)
 
-        for row in reader:
-            ts = (row.get("timestamp") or "").strip()
-            bpm_raw = (row.get("bpm") or "").strip()
-            if not ts or not bpm_raw:
-                continue
-            try:
-                bpm = int(float(bpm_raw))
-            except ValueError:
-                continue
-
-            status = detect_status(bpm)
-            db.execute(
-                "INSERT INTO readings (user_id, ts, bpm, status, label, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-                (uid, ts, bpm, status, None, dt.datetime.utcnow().isoformat())
-            )
-            inserted += 1
-
-        db.commit()
         flash(f"Uploaded successfully. Inserted {inserted} rows.", "success")
         return redirect(url_for("dashboard"))
 
@@ -373,7 +724,6 @@ def upload():
 @app.route("/contacts", methods=["GET", "POST"])
 @login_required
 def contacts():
-    db = get_db()
     uid = session["user_id"]
 
     if request.method == "POST":
@@ -385,37 +735,23 @@ def contacts():
             flash("Contact name is required.", "warning")
             return redirect(url_for("contacts"))
 
-        db.execute(
+        get_db().execute(
             "INSERT INTO contacts (user_id, name, phone, email, created_at) VALUES (?, ?, ?, ?, ?)",
             (uid, name, phone, email, dt.datetime.utcnow().isoformat())
         )
-        db.commit()
+        bump_user_version(uid)
         flash("Contact added.", "success")
         return redirect(url_for("contacts"))
 
-    items = db.execute(
-        "SELECT * FROM contacts WHERE user_id=? ORDER BY id DESC",
-        (uid,)
-    ).fetchall()
+    items = get_db().execute(USER_CONTACTS_SQL, (uid,)).fetchall()
     return render_template("contacts.html", contacts=items)
 
 
 @app.route("/history")
 @login_required
 def history():
-    db = get_db()
     uid = session["user_id"]
-
-    readings = db.execute(
-        "SELECT ts, bpm, COALESCE(status,'normal') AS status, label FROM readings WHERE user_id=? ORDER BY ts DESC LIMIT 200",
-        (uid,)
-    ).fetchall()
-
-    alerts = db.execute(
-        "SELECT ts, bpm, location, recipients FROM alerts WHERE user_id=? ORDER BY ts DESC LIMIT 50",
-        (uid,)
-    ).fetchall()
-
+    readings, alerts = _history_data(uid, _user_ver.get(uid, 0))
     return render_template("history.html", readings=readings, alerts=alerts)
 
 